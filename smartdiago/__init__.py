@@ -0,0 +1,7 @@
+# smartdiago
+"""Shared helpers for the SmartDiago Streamlit app.
+
+`smartdiago.api` owns everything that talks to the Grok (x.ai) endpoint —
+sessions, streaming, caching, async fan-out; `smartdiago.report` owns PDF
+generation. `app.py` keeps the UI and session-state wiring.
+"""
@@ -0,0 +1,291 @@
+# smartdiago/api.py
+"""Grok (x.ai) chat API client: pooled sessions, streaming, caching and
+async fan-out. Imported once by app.py so there is exactly one canonical
+implementation (and one set of cache keys) per process."""
+
+import os
+import json
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from typing import Dict, Iterator, List
+
+import orjson
+import streamlit as st
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import httpx
+import numpy as np
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:  # semantic cache degrades to exact-match only
+    SentenceTransformer = None
+
+API_URL = "https://api.x.ai/v1/chat/completions"
+
+@st.cache_resource(show_spinner=False)
+def _load_api_key():
+    # st.secrets reads + parses the TOML file under the hood; cache so the
+    # lookup happens once per process instead of on every rerun
+    return st.secrets.get("GROQ_API_KEY") or os.getenv("GROQ_API_KEY")
+
+API_KEY = _load_api_key()
+DEFAULT_MODEL = "grok-beta"
+
+@st.cache_resource(show_spinner=False)
+def worker_pool() -> ThreadPoolExecutor:
+    # shared worker pool for fire-and-forget Grok calls
+    return ThreadPoolExecutor(max_workers=4)
+
+@st.cache_resource(show_spinner=False)
+def _http() -> requests.Session:
+    # One pooled session for all sync calls: keep-alive reuses the TCP/TLS
+    # connection to api.x.ai instead of paying a fresh handshake per call,
+    # and transient 429/5xx responses are retried with exponential backoff.
+    s = requests.Session()
+    s.headers.update({"Authorization": f"Bearer {API_KEY}", "Content-Type": "application/json"})
+    retry = Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=["POST"])
+    s.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry))
+    return s
+
+def show_api_warning():
+    st.error(
+        "🚨 GROQ_API_KEY not found or invalid.\n"
+        "Set GROQ_API_KEY in Streamlit Secrets (`.streamlit/secrets.toml`) or as an environment variable."
+    )
+    st.stop()
+
+def require_api_key(fn):
+    """Guard the call path once instead of re-checking API_KEY inline.
+
+    Also acts as a circuit breaker: after one 401/403 the session is marked
+    disabled so follow-up clicks fail fast instead of burning a round-trip
+    on a call that cannot succeed.
+    """
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not API_KEY or st.session_state.get("_api_disabled"):
+            show_api_warning()
+        return fn(*args, **kwargs)
+    return wrapper
+
+def _check_auth(resp):
+    if resp.status_code in (401, 403):
+        st.session_state["_api_disabled"] = True
+        show_api_warning()
+
+def _error_body(resp) -> str:
+    # don't decode arbitrarily large error payloads just to format a message
+    if int(resp.headers.get("content-length") or 0) > 1_000_000:
+        return "<error body omitted: too large>"
+    return resp.text
+
+def grok_errors(fn):
+    """Render Grok failures uniformly instead of per-site try/except."""
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            st.error(f"Error calling Grok API: {e}")
+            st.stop()
+    return wrapper
+
+@require_api_key
+def call_grok_chat(messages: List[Dict], model: str = DEFAULT_MODEL, temperature: float = 0.0,
+                   max_tokens: int = 1024, response_format: Dict = None):
+    """Call Grok / x.ai chat endpoint with error handling."""
+    payload = {"model": model, "messages": messages, "temperature": temperature, "max_tokens": max_tokens}
+    if response_format is not None:
+        payload["response_format"] = response_format
+    try:
+        resp = _http().post(API_URL, data=orjson.dumps(payload), timeout=30)
+        _check_auth(resp)
+        resp.raise_for_status()
+        data = orjson.loads(resp.content)
+        return data["choices"][0]["message"]["content"]
+    except requests.HTTPError as e:
+        if resp.status_code == 400 and "Incorrect API key" in _error_body(resp):
+            st.error("🚨 Invalid GROQ_API_KEY provided. Please update your key in Streamlit Secrets or environment.")
+            st.stop()
+        else:
+            raise RuntimeError(f"API error {resp.status_code}: {_error_body(resp)}") from e
+    except Exception as e:
+        raise RuntimeError(f"Unexpected error calling Grok API: {e}") from e
+
+class GrokAuthError(RuntimeError):
+    """Auth failure (401/403) raised by grok_chat_raw; the script thread
+    trips the circuit breaker when it collects the future."""
+
+def http_session() -> requests.Session:
+    """Accessor for the pooled session. Callers handing work to
+    worker_pool resolve it here first: st.cache_resource needs the script
+    thread's ScriptRunContext, which worker threads don't have."""
+    return _http()
+
+def grok_chat_raw(session: requests.Session, messages: List[Dict], model: str = DEFAULT_MODEL,
+                  temperature: float = 0.0, max_tokens: int = 1024) -> str:
+    """Streamlit-free variant of call_grok_chat, safe on worker threads.
+
+    No session-state access and no st.* calls: from a thread without a
+    ScriptRunContext those silently miss the real session, so errors are
+    raised as exceptions for the script thread to render when the future
+    resolves."""
+    payload = {"model": model, "messages": messages, "temperature": temperature, "max_tokens": max_tokens}
+    resp = session.post(API_URL, data=orjson.dumps(payload), timeout=30)
+    if resp.status_code in (401, 403):
+        raise GrokAuthError(f"auth error {resp.status_code}")
+    if resp.status_code >= 400:
+        raise RuntimeError(f"API error {resp.status_code}: {_error_body(resp)}")
+    return orjson.loads(resp.content)["choices"][0]["message"]["content"]
+
+STREAM_FLUSH_INTERVAL = 0.05  # seconds between placeholder repaints
+
+@require_api_key
+def stream_grok(messages: List[Dict], model: str = DEFAULT_MODEL, temperature: float = 0.0,
+                max_tokens: int = 1024) -> Iterator[str]:
+    """Yield completion deltas from the SSE stream as they arrive.
+
+    Generator form so any consumer (placeholder painter, st.write_stream,
+    future websocket fan-out) can render tokens incrementally; time to
+    first token is ~one round-trip rather than the whole generation.
+    """
+    payload = {"model": model, "messages": messages, "temperature": temperature,
+               "max_tokens": max_tokens, "stream": True}
+    with _http().post(API_URL, data=orjson.dumps(payload), timeout=30, stream=True) as resp:
+        _check_auth(resp)
+        try:
+            resp.raise_for_status()
+        except requests.HTTPError as e:
+            raise RuntimeError(f"API error {resp.status_code}: {_error_body(resp)}") from e
+        for raw in resp.iter_lines():
+            if not raw:
+                continue
+            line = raw.decode("utf-8")
+            if not line.startswith("data:"):
+                continue
+            chunk = line[5:].strip()
+            if chunk == "[DONE]":
+                break
+            delta = orjson.loads(chunk)["choices"][0].get("delta", {}).get("content")
+            if delta:
+                yield delta
+
+def stream_grok_chat(messages: List[Dict], model: str = DEFAULT_MODEL, temperature: float = 0.0,
+                     max_tokens: int = 1024, placeholder=None) -> str:
+    """Consume stream_grok, pushing partial text into `placeholder` (batched
+    to one repaint per ~50 ms to avoid rerender storms on fast models).
+    Returns the full completion text."""
+    acc = []
+    last_flush = 0.0
+    for delta in stream_grok(messages, model=model, temperature=temperature, max_tokens=max_tokens):
+        acc.append(delta)
+        now = time.monotonic()
+        if placeholder is not None and now - last_flush > STREAM_FLUSH_INTERVAL:
+            placeholder.markdown("".join(acc))
+            last_flush = now
+    out = "".join(acc)
+    if placeholder is not None and out:
+        placeholder.markdown(out)
+    return out
+
+async def call_grok_chat_async(client: httpx.AsyncClient, messages: List[Dict], model: str = DEFAULT_MODEL,
+                               temperature: float = 0.0, max_tokens: int = 1024) -> str:
+    """Async variant of call_grok_chat; callers share one httpx client so
+    concurrent calls reuse a single connection pool."""
+    if not API_KEY:
+        raise RuntimeError("Missing GROQ_API_KEY. See instructions.")
+    headers = {"Authorization": f"Bearer {API_KEY}", "Content-Type": "application/json"}
+    payload = {"model": model, "messages": messages, "temperature": temperature, "max_tokens": max_tokens}
+    resp = await client.post(API_URL, headers=headers, content=orjson.dumps(payload), timeout=30)
+    resp.raise_for_status()
+    data = orjson.loads(resp.content)
+    return data["choices"][0]["message"]["content"]
+
+@grok_errors
+def run_prompts_parallel(prompt_messages: List[List[Dict]], max_tokens: int = 800) -> List[str]:
+    """Fire independent prompts concurrently with asyncio.gather — wall time
+    is roughly the slowest call instead of the sum of all of them."""
+    async def _run():
+        async with httpx.AsyncClient(http2=True, timeout=30) as client:
+            tasks = [call_grok_chat_async(client, m, max_tokens=max_tokens) for m in prompt_messages]
+            return await asyncio.gather(*tasks)
+    return asyncio.run(_run())
+
+# ---------- Response Cache ----------
+SEMANTIC_SIM_THRESHOLD = 0.95
+SEMANTIC_CACHE_MAX = 32  # entries kept per step
+
+@st.cache_resource
+def _embedder():
+    if SentenceTransformer is None:
+        return None
+    return SentenceTransformer("all-MiniLM-L6-v2")
+
+def _embed(text: str):
+    model = _embedder()
+    if model is None:
+        return None
+    return model.encode([text], normalize_embeddings=True)[0]
+
+def _semantic_cache(step: str) -> list:
+    # Partitioned per step: workflow prompts share one large stable context
+    # and differ only in a short task tail, so across steps the cosine
+    # similarity easily clears the threshold and one step's completion
+    # would be served as another's. Within a partition, near-identical
+    # contexts (e.g. a reworded symptom line) still hit.
+    return st.session_state.setdefault("llm_cache", {}).setdefault(step, [])
+
+def _semantic_cache_lookup(text: str, step: str):
+    cache = _semantic_cache(step)
+    if not cache:
+        return None
+    vec = _embed(text)
+    if vec is None:
+        return None
+    sims = np.stack([v for v, _ in cache]) @ vec
+    best = int(np.argmax(sims))
+    if sims[best] > SEMANTIC_SIM_THRESHOLD:
+        return cache[best][1]
+    return None
+
+def _semantic_cache_store(text: str, step: str, completion: str):
+    vec = _embed(text)
+    if vec is not None:
+        cache = _semantic_cache(step)
+        cache.append((vec, completion))
+        del cache[:-SEMANTIC_CACHE_MAX]  # bound per-session memory
+
+@st.cache_data(ttl=3600, show_spinner=False, max_entries=256)
+def _call_grok_exact(messages_json: str, model: str, temperature: float, max_tokens: int, _placeholder=None) -> str:
+    # underscore-prefixed args are excluded from the cache key; on a hit the
+    # body (and hence the streaming) is skipped and the text returns instantly
+    return stream_grok_chat(orjson.loads(messages_json), model=model, temperature=temperature,
+                            max_tokens=max_tokens, placeholder=_placeholder)
+
+def call_grok_cached(messages: List[Dict], model: str = DEFAULT_MODEL, temperature: float = 0.0,
+                     max_tokens: int = 1024, placeholder=None, step: str = "default") -> str:
+    """Cache layer in front of the Grok call: exact-match repeats are served
+    by st.cache_data, near-identical prompts by embedding similarity (within
+    the caller's `step` partition only), so repeat clicks skip the network +
+    LLM round-trip entirely. Cache misses stream tokens into `placeholder`
+    while the completion is generated."""
+    user_text = "\n".join(m["content"] for m in messages if m["role"] == "user")
+    hit = _semantic_cache_lookup(user_text, step)
+    if hit is not None:
+        if placeholder is not None:
+            placeholder.markdown(hit)
+        return hit
+    out = _call_grok_exact(json.dumps(messages, sort_keys=True), model, temperature, max_tokens,
+                           _placeholder=placeholder)
+    _semantic_cache_store(user_text, step, out)
+    return out
+
+@st.cache_data(ttl=3600, show_spinner=False, max_entries=64)
+def call_grok_json_cached(messages_json: str, model: str, temperature: float, max_tokens: int) -> str:
+    return call_grok_chat(orjson.loads(messages_json), model=model, temperature=temperature,
+                          max_tokens=max_tokens, response_format={"type": "json_object"})
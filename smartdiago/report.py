@@ -0,0 +1,112 @@
+# smartdiago/report.py
+"""Patient PDF report generation (fpdf2)."""
+
+from datetime import datetime
+from typing import Dict, List
+
+import streamlit as st
+
+# Font specs reused across the report; switching via _set_font skips the
+# no-op state changes that dominate fpdf's per-op cost in long timelines.
+BOLD12 = ("Arial", "B", 12)
+REG11 = ("Arial", "", 11)
+
+def _set_font(pdf, spec):
+    if getattr(pdf, "_current_font_spec", None) != spec:
+        pdf.set_font(*spec)
+        pdf._current_font_spec = spec
+
+def _pdf_safe(text: str) -> str:
+    # The built-in core fonts (Arial/Helvetica) only cover latin-1; any
+    # other character (Arabic or Polish patient names, smart quotes from an
+    # LLM answer) makes pdf.output() raise FPDFUnicodeEncodingException.
+    # Degrade those to '?' so the report always renders. Full fidelity
+    # would need a Unicode TTF registered via pdf.add_font(), which the
+    # repo doesn't ship.
+    return text.encode("latin-1", "replace").decode("latin-1")
+
+PDF_PARA_MAX_CHARS = 4096
+
+def _emit_paragraphs(pdf, text: str, height: int = 6):
+    """Feed long content to fpdf paragraph by paragraph.
+
+    fpdf's line-break loop degrades super-linearly on multi-KB strings, so
+    the layout engine never sees more than one paragraph (further split on
+    sentence boundaries past PDF_PARA_MAX_CHARS) per multi_cell call.
+    """
+    for para in text.split("\n\n"):
+        if not para.strip():
+            continue
+        if len(para) > PDF_PARA_MAX_CHARS:
+            chunk = []
+            size = 0
+            for sentence in para.replace("\n", " ").split(". "):
+                chunk.append(sentence)
+                size += len(sentence) + 2
+                if size >= PDF_PARA_MAX_CHARS:
+                    # new_x=LMARGIN/new_y=NEXT: fpdf2 otherwise parks the
+                    # cursor at the right margin and the next chunk has no
+                    # horizontal space to render in
+                    pdf.multi_cell(0, height, ". ".join(chunk), new_x="LMARGIN", new_y="NEXT")
+                    chunk, size = [], 0
+            if chunk:
+                pdf.multi_cell(0, height, ". ".join(chunk), new_x="LMARGIN", new_y="NEXT")
+        else:
+            pdf.multi_cell(0, height, para)
+        pdf.ln(1)
+
+def make_pdf_report(patient: Dict, timeline: List[Dict], uploaded_files: List[Dict]) -> bytes:
+    # deferred: fpdf pulls in font/glyph tables that most reruns never need
+    from fpdf import FPDF
+
+    pdf = FPDF()
+    pdf.set_auto_page_break(True, margin=15)
+    pdf.add_page()
+    pdf.set_font("Arial", "B", 16)
+    # plain hyphen: an em dash is outside latin-1 and would crash the core
+    # fonts just like un-sanitized user text
+    pdf.cell(0, 10, "SmartDiago - Patient Report", ln=True, align="C")
+    pdf.ln(4)
+    _set_font(pdf, REG11)
+    pdf.cell(0, 6, f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", ln=True)
+    pdf.ln(4)
+    _set_font(pdf, BOLD12)
+    pdf.cell(0, 7, "Patient Information:", ln=True)
+    _set_font(pdf, REG11)
+    # one multi_cell with embedded newlines = one speculative layout pass
+    # instead of one per field
+    pdf.multi_cell(0, 6, _pdf_safe("\n".join(f"{k}: {v}" for k, v in patient.items())))
+    pdf.ln(3)
+    # the default (regular 11pt) is set once before the loop; titles borrow
+    # bold via a scoped local_context instead of re-selecting fonts per entry
+    _set_font(pdf, REG11)
+    for entry in timeline:
+        with pdf.local_context(font_style="B", font_size_pt=12):
+            # fpdf2's multi_cell defaults to new_x=RIGHT; restore fpdf1's
+            # move-to-next-line behaviour or the content below starts at the
+            # right margin with no horizontal space
+            pdf.multi_cell(0, 7, _pdf_safe(entry.get("title", "")), new_x="LMARGIN", new_y="NEXT")
+        _emit_paragraphs(pdf, _pdf_safe(entry.get("content", "")))
+        pdf.ln(2)
+    if uploaded_files:
+        _set_font(pdf, BOLD12)
+        pdf.cell(0, 7, "Uploaded Files:", ln=True)
+        _set_font(pdf, REG11)
+        pdf.multi_cell(0, 6, _pdf_safe("\n".join(f"- {f['name']} ({f['type']})" for f in uploaded_files)))
+    # bytes() copy is required: st.download_button rejects bytearray, and
+    # the value round-trips through st.cache_data's pickle anyway
+    return bytes(pdf.output())
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def build_report_cached(patient_items: tuple, timeline_items: tuple, file_meta: tuple) -> bytes:
+    """Memoized front-end for make_pdf_report.
+
+    Keys are cheap hashable tuples — file bytes are deliberately excluded;
+    each file is identified by (name, type, content hash), so a re-upload
+    with different content busts the cache while repeated generate/download
+    clicks with unchanged inputs skip FPDF entirely.
+    """
+    patient = dict(patient_items)
+    timeline = [{"title": t, "content": c} for t, c in timeline_items]
+    files = [{"name": n, "type": t} for n, t, _h in file_meta]
+    return make_pdf_report(patient, timeline, files)